@@ -4,18 +4,69 @@ Flask + yt-dlp with proper error handling
 """
 
 from flask import Flask, request, jsonify, send_file
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from werkzeug.wsgi import FileWrapper
+import orjson
 import yt_dlp
+from settings import MAX_DOWNLOADS, MAX_DOWNLOAD_REQUESTS
 import os
+import re
+import functools
 import hashlib
+import secrets
 import time
-from pathlib import Path
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import traceback
 
+class OrjsonProvider(JSONProvider):
+    """Serve and parse JSON with orjson instead of the stdlib json module"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # orjson already produces bytes, so skip the str round-trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
+# Read size per iteration when Python itself streams a file
+FILE_BLOCK_SIZE = 1 << 20
+
+def _large_block_file_wrapper(file, buffer_size=8192):
+    return FileWrapper(file, FILE_BLOCK_SIZE)
+
+class FileWrapperMiddleware:
+    """Stream files in 1 MiB blocks when the server has no wsgi.file_wrapper
+
+    Servers that provide their own wrapper (gunicorn) are left alone, since
+    theirs can hand the file descriptor to sendfile(2) directly.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        environ.setdefault('wsgi.file_wrapper', _large_block_file_wrapper)
+        return self.wsgi_app(environ, start_response)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+app.wsgi_app = FileWrapperMiddleware(app.wsgi_app)
 CORS(app)
 
+# Let a fronting server stream files from disk (sendfile) instead of Python.
+# USE_X_SENDFILE=1 emits X-Sendfile (Apache mod_xsendfile, lighttpd);
+# X_ACCEL_REDIRECT=/internal-prefix/ emits X-Accel-Redirect for nginx.
+app.use_x_sendfile = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+X_ACCEL_REDIRECT = os.environ.get('X_ACCEL_REDIRECT', '')
+
 # Enhanced logging
 logging.basicConfig(
     level=logging.DEBUG,
@@ -24,34 +75,398 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 DOWNLOAD_FOLDER = os.path.join(os.getcwd(), 'downloads')
-Path(DOWNLOAD_FOLDER).mkdir(exist_ok=True)
+os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+# Precomputed so per-request paths are a plain string concatenation
+DOWNLOAD_PREFIX = DOWNLOAD_FOLDER + os.sep
 MAX_FILE_AGE = 3600
+# Sidecar holding a finished file's title and completion time
+META_SUFFIX = '.json'
+CLEANUP_INTERVAL = 60
+
+# All supported URL shapes fused into one pattern, compiled once at import
+VIDEO_ID_RE = re.compile(
+    r'(?:youtube\.com\/watch\?v=|youtu\.be\/|youtube\.com\/embed\/|youtube\.com\/v\/)([^&\n?#]+)'
+)
+# Anything but letters, digits, space, hyphen and underscore (\w is Unicode
+# aware, matching str.isalnum() plus '_')
+UNSAFE_TITLE_RE = re.compile(r'[^\w \-]')
+
+SUPPORTED_FORMATS = ('mp4', 'mp3')
+MP4_QUALITIES = ('720', '480', '360')
+
+INFO_CACHE_SIZE = 1024
+INFO_CACHE_TTL = 600
+
+class TTLCache:
+    """Small thread-safe LRU cache whose entries expire after `ttl` seconds"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+info_cache = TTLCache(INFO_CACHE_SIZE, INFO_CACHE_TTL)
+
+# (video_id, format, quality) -> Future of the download currently running
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# yt-dlp jobs run on a bounded pool; when every slot is busy new downloads
+# are rejected with 503 instead of piling up behind the running ones
+download_executor = ThreadPoolExecutor(max_workers=MAX_DOWNLOADS, thread_name_prefix='download')
+_download_slots = threading.BoundedSemaphore(MAX_DOWNLOADS)
+# Held for the whole of each /api/download request, see limit_download_requests
+_download_requests = threading.BoundedSemaphore(MAX_DOWNLOAD_REQUESTS)
+
+INFO_YDL_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': False,
+}
+# YoutubeDL isn't safe to share across threads, so each thread keeps its own
+_info_ydl = threading.local()
+
+def get_info_ydl():
+    """Return this thread's reusable YoutubeDL for metadata lookups"""
+    ydl = getattr(_info_ydl, 'ydl', None)
+    if ydl is None:
+        ydl = _info_ydl.ydl = yt_dlp.YoutubeDL(INFO_YDL_OPTS)
+    return ydl
+
+_cleanup_lock = threading.Lock()
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
 def cleanup_old_files():
+    # Skip if a sweep is already running rather than queueing another one
+    if not _cleanup_lock.acquire(blocking=False):
+        return
     try:
         current_time = time.time()
-        for filename in os.listdir(DOWNLOAD_FOLDER):
-            filepath = os.path.join(DOWNLOAD_FOLDER, filename)
-            if os.path.isfile(filepath):
-                if current_time - os.path.getmtime(filepath) > MAX_FILE_AGE:
-                    os.remove(filepath)
-                    logger.info(f"Cleaned up: {filename}")
+        with os.scandir(DOWNLOAD_FOLDER) as entries:
+            for entry in entries:
+                # One bad entry (vanished, locked) must not abort the sweep.
+                # is_dir() comes from readdir's d_type, so it costs no syscall;
+                # unlinking a directory fails differently per OS (EISDIR on
+                # Linux, EPERM on macOS), so skip them up front.
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        continue
+                    if current_time - entry.stat(follow_symlinks=False).st_mtime <= MAX_FILE_AGE:
+                        continue
+                    is_meta = entry.name.endswith(META_SUFFIX)
+                    # Sidecars go with their file; only drop orphans here
+                    if is_meta and os.path.exists(entry.path[:-len(META_SUFFIX)]):
+                        continue
+                    os.remove(entry.path)
+                    if not is_meta:
+                        remove_quietly(entry.path + META_SUFFIX)
+                    logger.info(f"Cleaned up: {entry.name}")
+                except FileNotFoundError:
+                    # Another worker's sweep (or a rename) got there first
+                    pass
+                except OSError as e:
+                    logger.error(f"Cleanup error for {entry.name}: {e}")
     except Exception as e:
         logger.error(f"Cleanup error: {e}")
+    finally:
+        _cleanup_lock.release()
 
-def extract_video_id(url):
-    import re
-    patterns = [
-        r'(?:youtube\.com\/watch\?v=|youtu\.be\/)([^&\n?#]+)',
-        r'youtube\.com\/embed\/([^&\n?#]+)',
-        r'youtube\.com\/v\/([^&\n?#]+)'
-    ]
-    for pattern in patterns:
-        match = re.search(pattern, url)
-        if match:
-            return match.group(1)
+def _cleanup_loop():
+    while True:
+        time.sleep(CLEANUP_INTERVAL)
+        cleanup_old_files()
+
+def start_cleanup_thread():
+    """Sweep stale downloads in the background instead of on each request
+
+    Called by the server entry points (gunicorn's post_worker_init hook, or
+    __main__), not at import, so importing the module has no side effects.
+    """
+    thread = threading.Thread(target=_cleanup_loop, name='cleanup', daemon=True)
+    thread.start()
+    return thread
+
+def count_files():
+    with os.scandir(DOWNLOAD_FOLDER) as entries:
+        return sum(1 for _ in entries)
+
+def find_downloaded_file(info, stem):
+    """Locate the file yt-dlp produced for the output template `stem`"""
+    # yt-dlp reports the final (post-processed) path directly
+    requested = info.get('requested_downloads') or [{}]
+    filepath = requested[0].get('filepath')
+    if filepath and os.path.exists(filepath):
+        return filepath
+    
+    # Fall back to one directory scan for any extension yt-dlp picked
+    with os.scandir(DOWNLOAD_FOLDER) as entries:
+        return next(
+            (entry.path for entry in entries
+             if entry.name.startswith(stem)
+             and not entry.name.endswith(('.part', '.ytdl'))),
+            None
+        )
+
+def download_path(filename_hash, format_type):
+    """Where the finished file for a (video, format, quality) hash lives
+
+    Kept ASCII so the name is safe in X-Sendfile/X-Accel-Redirect headers;
+    the title lives in the metadata sidecar next to it.
+    """
+    return DOWNLOAD_PREFIX + f"{filename_hash}.{format_type}"
+
+def write_download_meta(filepath, title):
+    # Written to a temp name and renamed so readers never see a partial file
+    temp_path = f"{filepath}.{secrets.token_hex(4)}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(orjson.dumps({'title': clean_title(title), 'completed': time.time()}))
+    os.replace(temp_path, filepath + META_SUFFIX)
+
+def read_download_meta(filepath):
+    """Return the sidecar metadata for a finished file, or None"""
+    try:
+        with open(filepath + META_SUFFIX, 'rb') as f:
+            return orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return None
+
+def touch_download(filepath):
+    """Refresh a reused file's mtime so the sweep keeps it; False if it's gone"""
+    try:
+        os.utime(filepath)
+        return True
+    except FileNotFoundError:
+        return False
+
+def clean_title(title):
+    # Only letters, digits, space, hyphen and underscore; limit length
+    return UNSAFE_TITLE_RE.sub('', title).rstrip()[:50] or 'video'
+
+class DownloadFileNotFound(Exception):
+    """yt-dlp finished but its output file could not be located"""
+
+    def __init__(self, expected, files):
+        super().__init__(f"Download completed but file not found: {expected}")
+        self.expected = expected
+        self.files = files
+
+def build_download_opts(format_type, quality, output_template):
+    if format_type == 'mp3':
+        # MP3 download options
+        ydl_opts = {
+            'format': 'bestaudio/best',
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': quality,
+            }],
+        }
+    else:
+        # MP4 download options
+        # Simplified format selection for Railway
+        if quality == '720':
+            format_selector = 'best[height<=720][ext=mp4]/best[height<=720]/best'
+        elif quality == '480':
+            format_selector = 'best[height<=480][ext=mp4]/best[height<=480]/best'
+        else:  # 360
+            format_selector = 'best[height<=360][ext=mp4]/best[height<=360]/best'
+        
+        ydl_opts = {'format': format_selector}
+    
+    ydl_opts.update({
+        'outtmpl': output_template,
+        # Keep mtime at download time so the cleanup sweep ages files correctly
+        'updatetime': False,
+        'quiet': False,
+        'no_warnings': False,
+        'verbose': True,
+    })
+    return ydl_opts
+
+def run_download(url, format_type, quality, filename_hash):
+    """Download `url` with yt-dlp and return the finished file's path
+
+    The job writes under its own hidden name and renames the result into
+    place, so a job for the same key in another worker process can't append
+    to our .part file or delete our intermediate file mid-conversion.
+    """
+    temp_stem = f".{filename_hash}-{secrets.token_hex(4)}"
+    output_template = DOWNLOAD_PREFIX + temp_stem
+    ydl_opts = build_download_opts(format_type, quality, output_template)
+    
+    logger.info(f"Starting download with options: {ydl_opts}")
+    
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=True)
+    
+    title = info.get('title', 'video')
+    logger.info(f"Download completed: {title}")
+    
+    # Find the downloaded file
+    temp_file = find_downloaded_file(info, temp_stem)
+    if not temp_file:
+        # List all files in download folder for debugging
+        raise DownloadFileNotFound(output_template, os.listdir(DOWNLOAD_FOLDER))
+    
+    # Metadata first, so any worker that sees the file can also read its title
+    downloaded_file = download_path(filename_hash, format_type)
+    write_download_meta(downloaded_file, title)
+    os.replace(temp_file, downloaded_file)
+    
+    logger.info(f"Found file: {downloaded_file}")
+    return downloaded_file
+
+class DownloadQueueFull(Exception):
+    """Every download slot is busy"""
+
+def submit_download(url, format_type, quality, filename_hash):
+    if not _download_slots.acquire(blocking=False):
+        raise DownloadQueueFull()
+    try:
+        future = download_executor.submit(run_download, url, format_type, quality, filename_hash)
+    except BaseException:
+        _download_slots.release()
+        raise
+    future.add_done_callback(lambda _: _download_slots.release())
+    return future
+
+def _finish_download(key, future):
+    with _inflight_lock:
+        _inflight.pop(key, None)
+
+def get_or_download(key, url, format_type, quality, filename_hash):
+    """Return the file path for `key`, coalescing concurrent downloads
+
+    A file already on disk (from any worker) is reused; otherwise the first
+    caller submits the download to `download_executor` and later callers for
+    the same key wait on the same Future instead of starting their own
+    yt-dlp job.
+    """
+    downloaded_file = download_path(filename_hash, format_type)
+    # One utime doubles as the existence check and keeps the sweep away
+    if touch_download(downloaded_file):
+        logger.info(f"Reusing file on disk for: {key}")
+        return downloaded_file
+    
+    with _inflight_lock:
+        future = _inflight.get(key)
+        owner = future is None
+        if owner:
+            # A job may have landed the file and left _inflight since the
+            # check above
+            if touch_download(downloaded_file):
+                return downloaded_file
+            future = submit_download(url, format_type, quality, filename_hash)
+            _inflight[key] = future
+    
+    if owner:
+        # Registered outside the lock: it runs inline if already finished
+        future.add_done_callback(lambda f: _finish_download(key, f))
+    else:
+        logger.info(f"Waiting on in-flight download for: {key}")
+    
+    return future.result()
+
+def validate_download_params(format_type, quality):
+    """Return an error message for an unsupported format/quality, else None"""
+    if format_type not in SUPPORTED_FORMATS:
+        return f"Unsupported format: {format_type}"
+    if format_type == 'mp4' and quality not in MP4_QUALITIES:
+        return f"Unsupported quality: {quality}"
+    # mp3 quality is the bitrate handed to FFmpegExtractAudio
+    if format_type == 'mp3' and not (quality.isascii() and quality.isdigit() and len(quality) <= 3):
+        return f"Unsupported quality: {quality}"
     return None
 
+def download_hash(video_id, format_type, quality):
+    """Deterministic filename stem for (video, format, quality)"""
+    # Delimited so ('abc', 'mp4', '720') and ('abc', 'mp47', '20') differ
+    key = '\0'.join((video_id, format_type, quality))
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+def server_busy():
+    return jsonify({
+        'success': False,
+        'error': 'Server busy, please retry shortly'
+    }), 503
+
+def on_response_close(response, func):
+    """Run `func` once the server is finished with `response`
+
+    Werkzeug hands a direct_passthrough body (send_file's file wrapper)
+    straight to the server, so call_on_close callbacks never fire for it;
+    chain onto the body's own close() instead, leaving the wrapper itself
+    in place so the server can still sendfile(2) it.
+    """
+    body = response.response
+    if response.direct_passthrough and hasattr(body, 'close'):
+        close = body.close
+
+        def close_then_run():
+            try:
+                close()
+            finally:
+                func()
+
+        body.close = close_then_run
+    else:
+        response.call_on_close(func)
+
+def limit_download_requests(view):
+    """Cap concurrent /api/download requests in this worker
+
+    A slot is held for the request's whole life (running a job, waiting on
+    someone else's, or streaming the file) and released when the response
+    closes, so downloads can never tie up the spare gunicorn threads that
+    /health and /api/info rely on.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not _download_requests.acquire(blocking=False):
+            logger.warning("Download rejected: all download request slots busy")
+            return server_busy()
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except BaseException:
+            _download_requests.release()
+            raise
+        on_response_close(response, _download_requests.release)
+        return response
+    return wrapper
+
+def read_json_body():
+    """Parse the request body with orjson without caching the raw bytes"""
+    return orjson.loads(request.get_data(cache=False) or b'{}')
+
+def extract_video_id(url):
+    match = VIDEO_ID_RE.search(url)
+    return match.group(1) if match else None
+
 @app.route('/')
 def index():
     return jsonify({
@@ -60,7 +475,7 @@ def index():
         'status': 'active',
         'endpoints': {
             '/api/info': 'POST - Get video info',
-            '/api/download': 'POST - Download video',
+            '/api/download': 'POST - Download video; GET - Re-fetch a downloaded file (supports Range)',
             '/health': 'GET - Health check'
         }
     })
@@ -68,7 +483,7 @@ def index():
 @app.route('/api/info', methods=['POST'])
 def get_video_info():
     try:
-        data = request.json
+        data = read_json_body()
         url = data.get('url')
         
         logger.info(f"Info request for: {url}")
@@ -80,28 +495,30 @@ def get_video_info():
         if not video_id:
             return jsonify({'success': False, 'error': 'Invalid YouTube URL'}), 400
         
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
+        cached = info_cache.get(video_id)
+        if cached:
+            logger.info(f"Info cache hit for: {video_id}")
+            return jsonify({'success': True, 'data': cached})
+        
+        info = get_info_ydl().extract_info(url, download=False)
+        
+        logger.info(f"Info retrieved for: {info.get('title')}")
+        
+        # Only keep the small summary; the raw info dict can be megabytes
+        video_data = {
+            'id': video_id,
+            'title': info.get('title'),
+            'thumbnail': info.get('thumbnail'),
+            'duration': info.get('duration'),
+            'channel': info.get('uploader')
         }
+        info_cache.set(video_id, video_data)
+        
+        return jsonify({
+            'success': True,
+            'data': video_data
+        })
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            logger.info(f"Info retrieved for: {info.get('title')}")
-            
-            return jsonify({
-                'success': True,
-                'data': {
-                    'id': video_id,
-                    'title': info.get('title'),
-                    'thumbnail': info.get('thumbnail'),
-                    'duration': info.get('duration'),
-                    'channel': info.get('uploader')
-                }
-            })
-            
     except Exception as e:
         logger.error(f"Info error: {str(e)}")
         logger.error(traceback.format_exc())
@@ -110,131 +527,140 @@ def get_video_info():
             'error': f'Failed to get video info: {str(e)}'
         }), 500
 
-@app.route('/api/download', methods=['POST'])
-def download_video():
+def parse_download_params(data):
+    """Validate a download request
+
+    Returns ((url, video_id, format_type, quality), None) on success or
+    (None, error_response) when the request should be rejected.
+    """
+    url = data.get('url')
+    format_type = str(data.get('format', 'mp4'))
+    quality = str(data.get('quality', '720'))
+    
+    logger.info(f"Download request - URL: {url}, Format: {format_type}, Quality: {quality}")
+    
+    if not url:
+        return None, (jsonify({'success': False, 'error': 'URL required'}), 400)
+    
+    video_id = extract_video_id(url)
+    if not video_id:
+        return None, (jsonify({'success': False, 'error': 'Invalid YouTube URL'}), 400)
+    
+    error = validate_download_params(format_type, quality)
+    if error:
+        return None, (jsonify({'success': False, 'error': error}), 400)
+    
+    return (url, video_id, format_type, quality), None
+
+def send_download(downloaded_file, format_type):
+    meta = read_download_meta(downloaded_file) or {}
+    download_name = f"{meta.get('title', 'video')}.{format_type}"
+    
+    # Reuse refreshes the file's mtime for the sweep, so derive ETag and
+    # Last-Modified from the completion time instead; they must stay stable
+    # for If-Range resumes and If-None-Match revalidation to work.
+    validators = {}
+    if 'completed' in meta:
+        validators = {
+            'etag': f"{os.path.basename(downloaded_file)}-{meta['completed']}",
+            'last_modified': meta['completed'],
+        }
+    
+    logger.info(f"Sending file: {downloaded_file} as {download_name}")
+    
+    # Send file (conditional enables ETag, Last-Modified and Range).
+    # Passing a path lets werkzeug set Content-Length from its own stat,
+    # so responses are never chunked and the server can use sendfile.
     try:
-        cleanup_old_files()
+        response = send_file(
+            downloaded_file,
+            as_attachment=True,
+            download_name=download_name,
+            mimetype='audio/mpeg' if format_type == 'mp3' else 'video/mp4',
+            conditional=True,
+            **validators
+        )
+    except FileNotFoundError:
+        # Swept between the lookup and here
+        logger.warning(f"File vanished before sending: {downloaded_file}")
+        return jsonify({'success': False, 'error': 'File expired, please retry'}), 404
+    # One-off files: shared proxies must not cache them, and must not
+    # re-compress already-compressed media (which also defeats sendfile)
+    response.headers['Cache-Control'] = 'private, max-age=0, no-transform'
+    
+    if X_ACCEL_REDIRECT:
+        response.close()
+        response.set_data(b'')
+        response.direct_passthrough = False
+        response.headers['X-Accel-Redirect'] = X_ACCEL_REDIRECT + os.path.basename(downloaded_file)
+    
+    # The file is kept so repeat and concurrent requests can reuse it;
+    # the background sweep removes it once it is MAX_FILE_AGE old.
+    return response
+
+@app.route('/api/download', methods=['GET'])
+@limit_download_requests
+def serve_download():
+    """Serve an already-downloaded file; never starts a yt-dlp job
+
+    Werkzeug only honours Range/If-Range on GET, so this is what lets
+    browsers resume or fetch ranges of a large file. Keeping it read-only
+    means a prefetcher, crawler or HEAD probe can't trigger a download.
+    """
+    try:
+        params, error_response = parse_download_params(request.args)
+        if error_response:
+            return error_response
+        url, video_id, format_type, quality = params
         
-        data = request.json
-        url = data.get('url')
-        format_type = data.get('format', 'mp4')
-        quality = data.get('quality', '720')
+        downloaded_file = download_path(download_hash(video_id, format_type, quality), format_type)
+        if not touch_download(downloaded_file):
+            return jsonify({
+                'success': False,
+                'error': 'Not downloaded yet; start it with POST /api/download'
+            }), 404
         
-        logger.info(f"Download request - URL: {url}, Format: {format_type}, Quality: {quality}")
+        return send_download(downloaded_file, format_type)
         
-        if not url:
-            return jsonify({'success': False, 'error': 'URL required'}), 400
+    except Exception as e:
+        logger.error(f"Download error: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({
+            'success': False,
+            'error': f'Download failed: {str(e)}',
+            'traceback': traceback.format_exc()
+        }), 500
+
+@app.route('/api/download', methods=['POST'])
+@limit_download_requests
+def download_video():
+    try:
+        params, error_response = parse_download_params(read_json_body())
+        if error_response:
+            return error_response
+        url, video_id, format_type, quality = params
         
-        video_id = extract_video_id(url)
-        if not video_id:
-            return jsonify({'success': False, 'error': 'Invalid YouTube URL'}), 400
+        # Deterministic filename per (video, format, quality) so repeats can reuse it
+        filename_hash = download_hash(video_id, format_type, quality)
         
-        # Generate unique filename
-        timestamp = int(time.time())
-        filename_hash = hashlib.md5(f"{video_id}{format_type}{quality}{timestamp}".encode()).hexdigest()[:8]
+        downloaded_file = get_or_download(
+            (video_id, format_type, quality), url, format_type, quality, filename_hash
+        )
+        return send_download(downloaded_file, format_type)
         
-        if format_type == 'mp3':
-            # MP3 download options
-            output_template = os.path.join(DOWNLOAD_FOLDER, f'{filename_hash}')
-            
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'outtmpl': output_template,
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': quality,
-                }],
-                'quiet': False,
-                'no_warnings': False,
-                'verbose': True,
-            }
-        else:
-            # MP4 download options
-            output_template = os.path.join(DOWNLOAD_FOLDER, f'{filename_hash}')
-            
-            # Simplified format selection for Railway
-            if quality == '720':
-                format_selector = 'best[height<=720][ext=mp4]/best[height<=720]/best'
-            elif quality == '480':
-                format_selector = 'best[height<=480][ext=mp4]/best[height<=480]/best'
-            else:  # 360
-                format_selector = 'best[height<=360][ext=mp4]/best[height<=360]/best'
-            
-            ydl_opts = {
-                'format': format_selector,
-                'outtmpl': output_template,
-                'quiet': False,
-                'no_warnings': False,
-                'verbose': True,
+    except DownloadQueueFull:
+        logger.warning("Download rejected: all download slots busy")
+        return server_busy()
+    except DownloadFileNotFound as e:
+        logger.error(f"File not found! Files in directory: {e.files}")
+        return jsonify({
+            'success': False,
+            'error': 'Download completed but file not found',
+            'debug': {
+                'expected': e.expected,
+                'files': e.files
             }
-        
-        logger.info(f"Starting download with options: {ydl_opts}")
-        
-        # Download the video
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            title = info.get('title', 'video')
-            
-            logger.info(f"Download completed: {title}")
-            
-            # Find the downloaded file
-            downloaded_file = None
-            possible_extensions = ['mp3', 'mp4', 'm4a', 'webm', 'mkv']
-            
-            for ext in possible_extensions:
-                potential_file = f"{output_template}.{ext}"
-                logger.info(f"Checking for file: {potential_file}")
-                if os.path.exists(potential_file):
-                    downloaded_file = potential_file
-                    logger.info(f"Found file: {downloaded_file}")
-                    break
-            
-            # Also check without extension
-            if not downloaded_file and os.path.exists(output_template):
-                downloaded_file = output_template
-                logger.info(f"Found file without extension: {downloaded_file}")
-            
-            if not downloaded_file:
-                # List all files in download folder for debugging
-                all_files = os.listdir(DOWNLOAD_FOLDER)
-                logger.error(f"File not found! Files in directory: {all_files}")
-                return jsonify({
-                    'success': False,
-                    'error': 'Download completed but file not found',
-                    'debug': {
-                        'expected': output_template,
-                        'files': all_files
-                    }
-                }), 500
-            
-            # Clean filename for download
-            safe_title = "".join(c for c in title if c.isalnum() or c in (' ', '-', '_')).rstrip()
-            safe_title = safe_title[:50]  # Limit length
-            download_name = f"{safe_title}.{format_type}"
-            
-            logger.info(f"Sending file: {downloaded_file} as {download_name}")
-            
-            # Send file
-            response = send_file(
-                downloaded_file,
-                as_attachment=True,
-                download_name=download_name,
-                mimetype='audio/mpeg' if format_type == 'mp3' else 'video/mp4'
-            )
-            
-            # Schedule file deletion after sending
-            @response.call_on_close
-            def cleanup():
-                try:
-                    if os.path.exists(downloaded_file):
-                        os.remove(downloaded_file)
-                        logger.info(f"Cleaned up: {downloaded_file}")
-                except Exception as e:
-                    logger.error(f"Cleanup failed: {e}")
-            
-            return response
-            
+        }), 500
     except Exception as e:
         logger.error(f"Download error: {str(e)}")
         logger.error(traceback.format_exc())
@@ -250,7 +676,7 @@ def health():
         'status': 'healthy',
         'timestamp': time.time(),
         'download_folder': DOWNLOAD_FOLDER,
-        'files_count': len(os.listdir(DOWNLOAD_FOLDER))
+        'files_count': count_files()
     })
 
 @app.route('/test')
@@ -277,4 +703,5 @@ if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     logger.info(f"Starting server on port {port}")
     logger.info(f"Download folder: {DOWNLOAD_FOLDER}")
+    start_cleanup_thread()
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,21 @@
+"""
+Gunicorn settings, picked up automatically from the working directory
+"""
+
+from settings import REQUEST_THREADS, WEB_CONCURRENCY
+
+# Threaded workers so one long download doesn't block /health and /api/info
+worker_class = 'gthread'
+workers = WEB_CONCURRENCY
+threads = REQUEST_THREADS
+
+# yt-dlp downloads (plus ffmpeg for mp3) can run for several minutes
+timeout = 600
+
+# Hand file responses to sendfile(2) instead of copying them through Python
+sendfile = True
+
+def post_worker_init(worker):
+    # Each worker sweeps the downloads folder in the background
+    from app import start_cleanup_thread
+    start_cleanup_thread()
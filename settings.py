@@ -0,0 +1,22 @@
+"""
+Concurrency settings shared by app.py and gunicorn.conf.py
+"""
+
+import os
+
+# Gunicorn worker processes. Kept small and fixed: inside containers
+# os.cpu_count() reports the host's CPUs, not the container's share.
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+# yt-dlp jobs allowed to run at once in each worker
+MAX_DOWNLOADS = int(os.environ.get('MAX_DOWNLOADS', 2))
+
+# /api/download requests handled at once in each worker, counting those
+# waiting on another request's job or streaming a file; beyond this they
+# get a 503
+MAX_DOWNLOAD_REQUESTS = int(os.environ.get('MAX_DOWNLOAD_REQUESTS', MAX_DOWNLOADS * 4))
+
+# Gunicorn request threads per worker: one per download request plus a few
+# that downloads can never occupy, so /health and /api/info always answer
+SPARE_THREADS = 4
+REQUEST_THREADS = MAX_DOWNLOAD_REQUESTS + SPARE_THREADS
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The app module with downloads redirected to a temp dir"""
+    monkeypatch.setattr(app_module, 'DOWNLOAD_FOLDER', str(tmp_path))
+    monkeypatch.setattr(app_module, 'DOWNLOAD_PREFIX', str(tmp_path) + os.sep)
+    app_module._inflight.clear()
+    return app_module
+
+
+@pytest.fixture
+def client(app):
+    return app.app.test_client()
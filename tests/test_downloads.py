@@ -0,0 +1,207 @@
+import os
+import threading
+import time
+
+import pytest
+
+KEY = ('abc', 'mp4', '720')
+URL = 'https://youtu.be/abc'
+
+
+def wait_for(predicate, timeout=2):
+    # Done-callbacks run on the executor thread, just after result() returns
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def fake_download(app, calls, started=None, release=None):
+    def run_download(url, format_type, quality, filename_hash):
+        calls.append(filename_hash)
+        if started:
+            started.set()
+        if release:
+            release.wait(5)
+        path = app.download_path(filename_hash, format_type)
+        app.write_download_meta(path, 'Title')
+        with open(path, 'wb') as f:
+            f.write(b'video')
+        return path
+    return run_download
+
+
+def test_ttl_cache_expires_and_evicts(app, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(app.time, 'monotonic', lambda: now[0])
+    cache = app.TTLCache(maxsize=2, ttl=10)
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)  # evicts 'b', the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+
+    now[0] = 11
+    assert cache.get('a') is None
+    assert cache.get('c') is None
+
+
+def test_concurrent_requests_share_one_download(app, monkeypatch):
+    calls = []
+    started, release = threading.Event(), threading.Event()
+    monkeypatch.setattr(app, 'run_download', fake_download(app, calls, started, release))
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(
+            app.get_or_download(KEY, URL, 'mp4', '720', 'hash')))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    assert started.wait(5)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert len(results) == 5 and len(set(results)) == 1
+    wait_for(lambda: not app._inflight)
+
+    # A repeat is served from disk without another job
+    assert app.get_or_download(KEY, URL, 'mp4', '720', 'hash') == results[0]
+    assert len(calls) == 1
+
+
+def test_full_slots_return_503(app, client, monkeypatch):
+    calls = []
+    monkeypatch.setattr(app, 'run_download', fake_download(app, calls))
+    for _ in range(app.MAX_DOWNLOADS):
+        app._download_slots.acquire()
+    try:
+        with pytest.raises(app.DownloadQueueFull):
+            app.get_or_download(KEY, URL, 'mp4', '720', 'hash')
+        response = client.post('/api/download', json={'url': URL})
+        assert response.status_code == 503
+        response.close()
+    finally:
+        for _ in range(app.MAX_DOWNLOADS):
+            app._download_slots.release()
+
+    assert calls == []
+    assert not app._inflight
+
+
+def test_failed_download_clears_inflight(app, monkeypatch):
+    calls = []
+
+    def broken_download(*args):
+        calls.append(args)
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(app, 'run_download', broken_download)
+
+    with pytest.raises(RuntimeError):
+        app.get_or_download(KEY, URL, 'mp4', '720', 'hash')
+    wait_for(lambda: not app._inflight)
+    wait_for(lambda: app._download_slots._value == app.MAX_DOWNLOADS)
+    assert not os.path.exists(app.download_path('hash', 'mp4'))
+
+    # The next request retries instead of reusing the failed Future
+    with pytest.raises(RuntimeError):
+        app.get_or_download(KEY, URL, 'mp4', '720', 'hash')
+    assert len(calls) == 2
+
+
+@pytest.fixture
+def stored_file(app):
+    path = app.download_path(app.download_hash(*KEY), 'mp4')
+    app.write_download_meta(path, 'Title')
+    with open(path, 'wb') as f:
+        f.write(b'x' * 1000)
+    return path
+
+
+def test_resumed_get_keeps_validators(app, client, stored_file):
+    url = f'/api/download?url={URL}'
+
+    first = client.get(url)
+    etag = first.headers['ETag']
+    assert first.status_code == 200
+    first.close()
+
+    resumed = client.get(url, headers={'Range': 'bytes=500-', 'If-Range': etag})
+    assert resumed.status_code == 206
+    assert resumed.headers['Content-Range'] == 'bytes 500-999/1000'
+    assert len(resumed.data) == 500
+    resumed.close()
+
+    revalidated = client.get(url, headers={'If-None-Match': etag})
+    assert revalidated.status_code == 304
+    revalidated.close()
+
+
+def etag_for(client):
+    response = client.get(f'/api/download?url={URL}')
+    response.close()
+    return response.headers['ETag']
+
+
+@pytest.mark.parametrize('method, headers, status', [
+    ('post', {}, 200),
+    ('get', {}, 200),
+    ('head', {}, 200),
+    ('get', {'Range': 'bytes=0-99'}, 206),
+    ('get', 'if-none-match', 304),
+])
+def test_download_request_slot_released(app, client, stored_file, method, headers, status):
+    if headers == 'if-none-match':
+        headers = {'If-None-Match': etag_for(client)}
+    send = getattr(client, method)
+    if method == 'post':
+        response = send('/api/download', json={'url': URL})
+    else:
+        response = send(f'/api/download?url={URL}', headers=headers)
+
+    assert response.status_code == status
+    response.close()
+    assert app._download_requests._value == app.MAX_DOWNLOAD_REQUESTS
+
+
+def test_download_request_slot_held_while_streaming(app, client, stored_file):
+    response = client.get(f'/api/download?url={URL}', buffered=False)
+    assert app._download_requests._value == app.MAX_DOWNLOAD_REQUESTS - 1
+    response.close()
+    assert app._download_requests._value == app.MAX_DOWNLOAD_REQUESTS
+
+
+def test_download_request_slot_released_for_x_accel(app, client, stored_file, monkeypatch):
+    monkeypatch.setattr(app, 'X_ACCEL_REDIRECT', '/protected/')
+    response = client.post('/api/download', json={'url': URL})
+
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'] == '/protected/' + os.path.basename(stored_file)
+    response.close()
+    assert app._download_requests._value == app.MAX_DOWNLOAD_REQUESTS
+
+
+@pytest.mark.parametrize('body, status', [
+    ({'url': 'not a url'}, 400),
+    ({'url': URL, 'quality': '999'}, 400),
+])
+def test_download_request_slot_released_for_errors(app, client, body, status):
+    response = client.post('/api/download', json=body)
+
+    assert response.status_code == status
+    response.close()
+    assert app._download_requests._value == app.MAX_DOWNLOAD_REQUESTS
+
+
+def test_missing_file_get_is_404_and_releases_slot(app, client):
+    response = client.get(f'/api/download?url={URL}')
+
+    assert response.status_code == 404
+    response.close()
+    assert app._download_requests._value == app.MAX_DOWNLOAD_REQUESTS